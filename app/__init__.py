@@ -1,12 +1,16 @@
 from flask import Flask, request, current_app
+from flask.json.provider import DefaultJSONProvider
+import orjson
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_login import LoginManager
-import logging, os
+import logging, os, atexit
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import SMTPHandler, RotatingFileHandler
 from flask_mail import Mail
 from flask_moment import Moment
+from flask_compress import Compress
 from flask_babel import Babel, lazy_gettext as _l
 from elasticsearch import Elasticsearch
 from redis import Redis
@@ -17,6 +21,22 @@ def get_locale():
     #return 'es'
     return request.accept_languages.best_match(current_app.config['LANGUAGES'])
 
+""" Flask's JSON provider but encoding/decoding with orjson, which is a lot faster than the standard json module """
+class ORJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        # datetimes are passed through to Flask's default() so they're still formatted the same way as before (HTTP date),
+        # default() also takes care of the other types orjson doesn't know about (e.g. Decimal, lazy strings with __html__)
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        # response() asks for an indented output in debug mode
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 db = SQLAlchemy() # database
 migrate = Migrate()
 login = LoginManager()
@@ -24,21 +44,35 @@ login.login_view = 'auth.login'
 login.login_message = _l('Please log in to access this page')
 mail = Mail()
 moment = Moment()
+# gzip/brotli compression of responses, negotiated with the browser through the Accept-Encoding header
+compress = Compress()
 babel = Babel()
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    app.json = ORJSONProvider(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
+    compress.init_app(app)
     babel.init_app(app, locale_selector=get_locale)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) if app.config['ELASTICSEARCH_URL'] else None
+    # one client (and its pool of connections) for the whole app, with gzipped request bodies for the bulk indexing requests
+    app.elasticsearch = Elasticsearch(
+        [app.config['ELASTICSEARCH_URL']],
+        http_compress=True,
+        request_timeout=30,
+        connections_per_node=app.config['ELASTICSEARCH_CONNECTIONS']
+    ) if app.config['ELASTICSEARCH_URL'] else None
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    # one pool of reusable threads for sending emails instead of starting a brand new thread for every email
+    # shutdown(wait=True) at exit lets the emails that are still being sent finish before the process goes away
+    app.extensions['mail_executor'] = ThreadPoolExecutor(max_workers=app.config['MAIL_POOL_SIZE'], thread_name_prefix='mail')
+    atexit.register(app.extensions['mail_executor'].shutdown, wait=True)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
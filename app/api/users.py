@@ -16,7 +16,8 @@ def get_user(id):
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users')
+    count = request.args.get('count', 'true') != 'false'
+    return User.to_collection_dict(sa.select(User), page, per_page, 'api.get_users', count=count)
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
@@ -24,7 +25,8 @@ def get_followers(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', id=id)
+    count = request.args.get('count', 'true') != 'false'
+    return User.to_collection_dict(user.followers.select(), page, per_page, 'api.get_followers', count=count, id=id)
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
@@ -32,7 +34,8 @@ def get_following(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following', id=id)
+    count = request.args.get('count', 'true') != 'false'
+    return User.to_collection_dict(user.following.select(), page, per_page, 'api.get_following', count=count, id=id)
 
 @bp.route('/users', methods=['POST'])
 def create_user():
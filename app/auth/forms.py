@@ -1,7 +1,7 @@
 """ different forms like registration, login, etc. where users can enter data for authentication purposes """
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import DataRequired, ValidationError, Email, EqualTo
+from wtforms.validators import DataRequired, Email, EqualTo
 import sqlalchemy as sa
 from app import db
 from app.models import User
@@ -14,15 +14,25 @@ class RegistrationForm(FlaskForm):
     password2 = PasswordField(_l('Repeat password'), validators=[DataRequired(), EqualTo('password')])
     submit = SubmitField(_l('Register'))
 
-    def validate_username(self, username):
-        user = db.session.scalar(sa.select(User).where(User.username == username.data))
-        if user is not None:
-            raise ValidationError(_('That username already exists! Please use a different username.'))
-
-    def validate_email(self, email):
-        user_email = db.session.scalar(sa.select(User).where(User.email == email.data))
-        if user_email is not None:
-            raise ValidationError(_('That email has already been used! Please use a different one.'))
+    """
+    checks that the username and the email are both still available with a single query (instead of one per field),
+    it runs after the field validators so the query is skipped when the form is invalid anyway
+    """
+    def validate(self, extra_validators=None):
+        if not super().validate(extra_validators):
+            return False
+        taken = db.session.execute(sa.select(User.username, User.email).where(
+            sa.or_(User.username == self.username.data, User.email == self.email.data))).all()
+        # lower() because some databases (e.g. MySQL) compare strings case-insensitively
+        if any(username.lower() == self.username.data.lower() for username, _email in taken):
+            self.username.errors.append(_('That username already exists! Please use a different username.'))
+        if any(email.lower() == self.email.data.lower() for _username, email in taken):
+            self.email.errors.append(_('That email has already been used! Please use a different one.'))
+        # the database can match a row that lower() doesn't (e.g. MySQL ignores accents and trailing spaces),
+        # the form is still refused, so the error is shown on the username
+        if taken and not self.username.errors and not self.email.errors:
+            self.username.errors.append(_('That username already exists! Please use a different username.'))
+        return not taken
 
 class LoginForm(FlaskForm):
     username = StringField(_l('Username'), validators=[DataRequired()])
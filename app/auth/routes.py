@@ -41,7 +41,14 @@ def register():
         user = User(username=form.username.data, email=form.email.data)
         user.set_password(form.password.data)
         db.session.add(user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError:
+            # the username and email columns are unique, so if someone else registered the same username/email
+            # between the validation and this commit, the database refuses it, and validating again shows which one
+            db.session.rollback()
+            form.validate()
+            return render_template('auth/register.html', title=_('Register'), form=form)
         flash(_("Congratulations, you're now a registered user!"))
         return redirect(url_for('auth.login'))
     return render_template('auth/register.html', title=_('Register'), form=form)
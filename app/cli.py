@@ -3,7 +3,12 @@ define custom Flask CLI commands (terminal commands) to shorten processes like:
 adding, updating, and compiling a new language for the web app
 """
 import os
+import glob
+import hashlib
+import subprocess
+import tempfile
 import click
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint
 
 # global app doesn't exist anymore, and current_app only works during the handling of a request, while
@@ -18,35 +23,94 @@ def translate():
     """Translation and localization commands."""
     pass
 
+""" runs a pybabel command directly (no shell in between) and turns a failure into the RuntimeError the commands raise """
+def _run(args, error):
+    try:
+        subprocess.run(args, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        raise RuntimeError(error)
+
+""" every language that has a messages.po file under app/translations """
+def _languages():
+    return sorted(lang for lang in os.listdir('app/translations')
+                  if os.path.exists(os.path.join('app/translations', lang, 'LC_MESSAGES', 'messages.po')))
+
+""" runs fn(lang) for each language at the same time, the pybabel processes are independent of each other """
+def _for_each_language(fn, langs):
+    with ThreadPoolExecutor() as executor:
+        # list() consumes the results so that an exception raised for any language is re-raised here
+        list(executor.map(fn, langs))
+
+"""
+extracting the messages is the slowest step, so the messages.pot file is kept in the temp directory (one per checkout)
+instead of being removed, and it's only extracted again when babel.cfg or a scanned .py/.html file is newer than it
+"""
+def _extract_once():
+    checkout = hashlib.blake2b(os.getcwd().encode(), digest_size=8).hexdigest()
+    pot_path = os.path.join(tempfile.gettempdir(), f'microblog-{checkout}-messages.pot')
+    sources = glob.glob('app/**/*.py', recursive=True) + glob.glob('app/templates/**/*.html', recursive=True)
+    newest = max(os.path.getmtime(path) for path in sources + ['babel.cfg'])
+    if not os.path.exists(pot_path) or os.path.getmtime(pot_path) < newest:
+        # extract into a temporary file and rename it, so an interrupted extract never looks like an up to date one
+        _run(['pybabel', 'extract', '-F', 'babel.cfg', '-k', '_l', '-o', pot_path + '.tmp', '.'], 'extract command failed')
+        os.replace(pot_path + '.tmp', pot_path)
+    return pot_path
+
 # name of the decorated function is the name of the command
 # e.g. flask translate init <language-code> initializes a new language
 # flask translate update updates all languages, and flask translate compile compiles all languages
 # all commands return the value 0 (meaning no errors returned)
-# the messages.pot file is removed after init and update because it can be easily regenerated when needed
 @translate.command()
 @click.argument('lang')
 def init(lang):
     """Initialize a new language."""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'):
-        raise RuntimeError('extract command failed')
-    if os.system(
-            'pybabel init -i messages.pot -d app/translations -l ' + lang):
-        raise RuntimeError('init command failed')
-    os.remove('messages.pot')
+    pot_path = _extract_once()
+    _run(['pybabel', 'init', '-i', pot_path, '-d', 'app/translations', '-l', lang], 'init command failed')
 
 
 @translate.command()
 def update():
     """Update all languages."""
-    if os.system('pybabel extract -F babel.cfg -k _l -o messages.pot .'):
-        raise RuntimeError('extract command failed')
-    if os.system('pybabel update -i messages.pot -d app/translations'):
-        raise RuntimeError('update command failed')
-    os.remove('messages.pot')
+    pot_path = _extract_once()
+    _for_each_language(
+        lambda lang: _run(['pybabel', 'update', '-i', pot_path, '-d', 'app/translations', '-l', lang], 'update command failed'),
+        _languages())
+
+
+""" blake2b digest of a .po file, stored next to the compiled .mo to know whether the .mo is still up to date """
+def _po_digest(po_path):
+    with open(po_path, 'rb') as f:
+        return hashlib.blake2b(f.read()).hexdigest()
 
+""" a language is stale when its .mo is missing, older than its .po, or was compiled from a .po with different contents """
+def _is_stale(po_path, digest):
+    mo_path = po_path[:-3] + '.mo'
+    if not os.path.exists(mo_path) or os.path.getmtime(mo_path) < os.path.getmtime(po_path):
+        return True
+    try:
+        with open(po_path + '.sha') as f:
+            return f.read().strip() != digest
+    except FileNotFoundError:
+        return True
 
 @translate.command()
-def compile():
+@click.option('--force', is_flag=True, help='Recompile every language even if it is up to date.')
+def compile(force):
     """Compile all languages."""
-    if os.system('pybabel compile -d app/translations'):
-        raise RuntimeError('compile command failed')
\ No newline at end of file
+    # only the languages whose .po file changed since the last compile are passed to pybabel
+    stale = []
+    for lang in _languages():
+        po_path = os.path.join('app/translations', lang, 'LC_MESSAGES', 'messages.po')
+        digest = _po_digest(po_path)
+        if force or _is_stale(po_path, digest):
+            stale.append((lang, po_path, digest))
+
+    def compile_language(item):
+        lang, po_path, digest = item
+        _run(['pybabel', 'compile', '-d', 'app/translations', '-l', lang], 'compile command failed')
+        # write the digest to a temporary file first and rename it so a half-written .sha is never left behind
+        with open(po_path + '.sha.tmp', 'w') as f:
+            f.write(digest)
+        os.replace(po_path + '.sha.tmp', po_path + '.sha')
+
+    _for_each_language(compile_language, stale)
@@ -1,14 +1,39 @@
 from flask_mail import Message
 from app import mail
 from flask import current_app
-from threading import Thread
+from rq import Retry
+import redis
 
 # makes send_email() function asynchronous to consume less resources and make the app run faster
 def send_async_email(app, msg):
     with app.app_context():
         mail.send(msg)
 
-def send_email(subject, sender, recipients, text_body, html_body, attachments=None, sync=False):
+""" same as send_async_email() but for a list of emails, see send_email_batch() """
+def send_async_email_batch(app, msgs):
+    with app.app_context():
+        _send_over_one_connection(msgs)
+
+""" 
+runs fn on the app's email thread pool, an exception (e.g. the SMTP server refused the email) is logged when fn is done,
+otherwise the pool would keep it in the returned Future and nobody would ever see it
+"""
+def _submit_to_pool(app, fn, *args):
+    def log_failure(future):
+        exception = future.exception()
+        if exception is not None:
+            app.logger.error('Failed to send email', exc_info=(type(exception), exception, exception.__traceback__))
+    future = app.extensions['mail_executor'].submit(fn, app, *args)
+    future.add_done_callback(log_failure)
+
+def _send_over_one_connection(msgs):
+    # mail.send() opens a new SMTP connection (TCP + TLS handshake + login) for every email,
+    # while mail.connect() keeps a single connection open and sends all the emails through it
+    with mail.connect() as conn:
+        for msg in msgs:
+            conn.send(msg)
+
+def _build_message(subject, sender, recipients, text_body, html_body, attachments=None):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
@@ -17,8 +42,45 @@ def send_email(subject, sender, recipients, text_body, html_body, attachments=No
         # using *attachment automatically passes the 3 elements in the attachment tuple as corresponding arguments
         for attachment in attachments:
             msg.attach(*attachment)
+    return msg
+
+def send_email(subject, sender, recipients, text_body, html_body, attachments=None, sync=False):
+    if not sync:
+        # hand the email to the task queue so the web worker doesn't wait on the SMTP round-trip at all,
+        # the same "rq worker microblog-tasks" that runs the other background tasks sends it (with sync=True)
+        # and queues it again up to 3 times if the SMTP server fails (right away, delayed retries would need "--with-scheduler")
+        # only plain arguments are queued since the worker renders nothing, it just builds the Message and sends it
+        try:
+            current_app.task_queue.enqueue('app.tasks.send_email_task', subject, sender, recipients, text_body, html_body,
+                                           attachments, retry=Retry(max=3))
+            return
+        except redis.exceptions.RedisError:
+            # Redis is not reachable (e.g. local development without a worker), so send from the app's thread pool instead
+            pass
+    msg = _build_message(subject, sender, recipients, text_body, html_body, attachments)
     if sync:
         mail.send(msg)
     else:
         # the current_app._get_current_object() expression extracts the actual application instance from inside the proxy object current_app
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
\ No newline at end of file
+        # the email is handed to the app's thread pool (see create_app) so threads are reused instead of created per email,
+        # failures are logged by _submit_to_pool()
+        _submit_to_pool(current_app._get_current_object(), send_async_email, msg)
+
+"""
+sends several emails at once (e.g. a broadcast to many users) through one SMTP connection,
+emails is a list of dicts with the same keyword arguments as send_email(): subject, sender, recipients, text_body, html_body
+and optionally attachments
+"""
+def send_email_batch(emails, sync=False):
+    if not sync:
+        # the whole batch is one job on the task queue, so the worker also sends it over a single connection
+        try:
+            current_app.task_queue.enqueue('app.tasks.send_email_batch_task', emails, retry=Retry(max=3))
+            return
+        except redis.exceptions.RedisError:
+            pass
+    msgs = [_build_message(**email) for email in emails]
+    if sync:
+        _send_over_one_connection(msgs)
+    else:
+        _submit_to_pool(current_app._get_current_object(), send_async_email_batch, msgs)
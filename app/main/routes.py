@@ -1,13 +1,20 @@
 """ handles the different URLs that the application supports - aka handling what logic to execute when a client requests a given URL """
 from datetime import datetime, timezone
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+import zlib
+import orjson
+from flask import render_template, flash, redirect, url_for, request, g, current_app, abort, stream_with_context, \
+    stream_template, get_flashed_messages
+from flask_wtf.csrf import generate_csrf
+from itsdangerous import BadSignature
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from app import db
+import sqlalchemy.orm as so
+from app import db, compress
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, MessageForm
 from app.models import User, Post, Message, Notification
 from app.main import bp
+from app.errors.handlers import wants_json_response
 
 """ keeps track of the logged in user's last time seen on the website and current preferred language """
 @bp.before_app_request
@@ -15,12 +22,95 @@ def before_request():
     # the g variable provided by Flask is a place where the application can store data 
     # that needs to persist through the life of a request
     # note that this g variable is specific to each request and each client
+    # static files never render a page, so they don't need the user, the search form or the locale
+    if request.endpoint == 'static':
+        return
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
-        g.search_form = SearchForm()
+        # last_seen only needs to be roughly right, so it is written at most once per LAST_SEEN_INTERVAL seconds
+        # instead of on every request (e.g. the notifications polling would otherwise commit every few seconds)
+        now = datetime.now(timezone.utc)
+        last_seen = current_user.last_seen
+        if last_seen is None or (now - last_seen).total_seconds() > current_app.config['LAST_SEEN_INTERVAL']:
+            current_user.last_seen = now
+            db.session.commit()
     g.locale = str(get_locale())
 
+""" 
+the search form of the navigation bar, it's only built the first time it's needed in a request instead of in before_request(), 
+so requests that don't render a page (e.g. the notifications polling) don't pay for it
+"""
+@bp.app_template_global()
+def get_search_form():
+    if 'search_form' not in g:
+        g.search_form = SearchForm()
+    return g.search_form
+
+# the user by username query is built once as a lambda statement, SQLAlchemy caches it by the code of the lambda,
+# so the select() expression isn't rebuilt on every call, only the username bound parameter changes
+_USER_BY_USERNAME = sa.lambda_stmt(lambda: sa.select(User).where(User.username == sa.bindparam('username')))
+
+""" looks up a user by username, the result is remembered in g so the same user is only queried once per request """
+def _get_user_by_username(username):
+    # g only lives for the current request, so there is no stale cache to invalidate (e.g. after a username change)
+    cache = g.setdefault('_user_cache', {})
+    if username not in cache:
+        cache[username] = db.session.scalar(_USER_BY_USERNAME, {'username': username})
+    return cache[username]
+
+"""
+one page of a post or message list (see FeedMixin.feed_page), the link to the next page carries the cursor of the next page
+- there is no link to newer items, the browser's back button does that
+"""
+def _feed_page(query, model, endpoint, **kwargs):
+    try:
+        items, next_cursor = model.feed_page(query, request.args.get('cursor'), current_app.config['POSTS_PER_PAGE'])
+    except BadSignature:
+        abort(400)
+    next_url = url_for(endpoint, cursor=next_cursor, **kwargs) if next_cursor else None
+    return items, next_url
+
+"""
+renders a page as a stream, so the first part of the page (navigation bar etc.) is sent while the rest is still rendering,
+used for the pages that list posts
+- once the first chunk is sent, the session cookie can't be changed anymore, but rendering the page changes the session:
+  the flashed messages are removed from it and the CSRF token of the forms is added to it
+- so both are done here before streaming starts, and Flask/Flask-WTF reuse them for the rest of the request
+- Flask-Compress can only compress a whole response (see COMPRESS_STREAMS in config.py), so when the browser accepts gzip
+  the page is gzipped here as it streams
+"""
+def _stream_page(template, **context):
+    get_flashed_messages()
+    generate_csrf()
+    chunks = stream_template(template, **context)
+    if request.accept_encodings['gzip']:
+        response = current_app.response_class(_gzip_stream(chunks, current_app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    return current_app.response_class(chunks)
+
+# how much of the page (in bytes) is compressed before the compressed data is sent, the template produces many tiny pieces
+# and flushing after each of them would add a few bytes to every piece instead of compressing it
+_GZIP_FLUSH_SIZE = 4096
+
+"""
+gzips the pieces of a streamed page, Z_SYNC_FLUSH pushes out everything compressed so far
+so the browser can already decompress and show that part of the page
+"""
+def _gzip_stream(chunks, level):
+    # wbits=31 writes the gzip header and trailer around the deflate data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        chunk = chunk.encode()
+        data = compressor.compress(chunk)
+        pending += len(chunk)
+        if pending >= _GZIP_FLUSH_SIZE:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if data:
+            yield data
+    yield compressor.flush()
+
 """
 - / is the default homepage route in most web apps
 - /index is more readable and conventional in some cases
@@ -41,14 +131,9 @@ def index():
         # when you refresh a page, the web browser just re-issues the last request, so if we don't redirect to make the last request
         # a GET request and instead still remain the POST request, it's gonna do the POST request again and might duplicate the post
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    # error_out returns empty list for False, 404 error for True when out of range error occur
-    posts = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) if posts.has_prev else None
-    # posts is now a Pagination object, and the .items attribute contains the list of items returned for the requested page 
-    # i.e. the list of posts to be displayed for the current page
-    return render_template('index.html', title = _('Homepage'), posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    # posts is the list of posts to be displayed for the current page
+    posts, next_url = _feed_page(current_user.following_posts(), Post, 'main.index')
+    return _stream_page('index.html', title = _('Homepage'), posts=posts, form=form, next_url=next_url)
 
 """
 explore page to explore other users and their posts
@@ -57,31 +142,30 @@ works like the home page (index) but disable blog posting & display global post
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) if posts.has_prev else None
-    return render_template('index.html', title=_('Explore'), posts=posts.items, next_url=next_url, prev_url=prev_url)
+    # _post.html shows the author of every post, so the authors are loaded together in one extra query instead of one per post
+    query = sa.select(Post).options(so.selectinload(Post.author)).order_by(Post.timestamp.desc())
+    posts, next_url = _feed_page(query, Post, 'main.explore')
+    return _stream_page('index.html', title=_('Explore'), posts=posts, next_url=next_url)
 
 """ displays user <username>'s profile """
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
+    user = _get_user_by_username(username)
+    if user is None:
+        abort(404)
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) if posts.has_prev else None
+    posts, next_url = _feed_page(query, Post, 'main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items, form=form, next_url=next_url, prev_url=prev_url)
+    return _stream_page('user.html', user=user, posts=posts, form=form, next_url=next_url)
 
 """ displays a popup with the user <username>'s profile when you hover over the user's name """
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = db.first_or_404(sa.select(User).where(User.username == username))
+    user = _get_user_by_username(username)
+    if user is None:
+        abort(404)
     form = EmptyForm()
     return render_template('user_popup.html', form=form, user=user)
 
@@ -92,7 +176,13 @@ def edit_profile():
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
-        db.session.commit()
+        try:
+            db.session.commit()
+        except sa.exc.IntegrityError:
+            # someone else took the username between the validation and this commit (see auth.register)
+            db.session.rollback()
+            form.validate()
+            return render_template('edit_profile.html', title=_('Edit profile'), form=form)
         flash(_('Your changes have been saved'))
         return redirect(url_for('main.edit_profile'))
     elif request.method == "GET":
@@ -100,73 +190,111 @@ def edit_profile():
         form.about_me.data = current_user.about_me
     return render_template('edit_profile.html', title=_('Edit profile'), form=form)
 
+"""
+- the follow/unfollow buttons use htmx (HX-Request header), so instead of redirecting to the whole profile page again,
+  only the _follow.html block with the new followers count and button is returned and swapped into the page
+- API-like clients asking for JSON get the new state as JSON
+- returns None for normal form submissions, which keep the redirect
+"""
+def _follow_fragment(user):
+    if request.headers.get('HX-Request'):
+        return render_template('_follow.html', user=user, form=EmptyForm())
+    if wants_json_response():
+        return {'following': current_user.is_following(user), 'followers_count': user.followers_count()}
+    return None
+
+"""
+redirects after a follow/unfollow that didn't go through (CSRF token missing/expired, user not found, the user themselves)
+- htmx would follow a redirect in the background and swap the whole page, navigation bar included, into the follow block,
+  so htmx requests get an empty response with the HX-Redirect header instead and htmx loads the page itself
+"""
+def _follow_redirect(location):
+    if request.headers.get('HX-Request'):
+        response = current_app.response_class(status=204)
+        response.headers['HX-Redirect'] = location
+        return response
+    return redirect(location)
+
 """
 - we split follow and unfollow instead of bundling them together in user() route to make the code clean, simple and maintainable
 - if we bundled them together, we would have to add a bunch of logic to check if we're trying to follow or unfollow
 - for these 2 follow and unfollow forms, the validate_on_submit() can only fail if the CSRF token is missing/invalid
-- also these forms do not have their own page, they will be rendered by the user() route and will appear in the user's profile page
+- also these forms do not have their own page, they are part of the _follow.html block of the user's profile page,
+  which is rendered by the user() route and, after a follow/unfollow through htmx, by these routes
 """
 @bp.route('/follow/<username>', methods=['POST'])
 @login_required
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.username == username))
+        user = _get_user_by_username(username)
         if user is None:
             flash(_('User %(username)s not found', username=username))
-            return redirect(url_for('main.index'))
+            return _follow_redirect(url_for('main.index'))
         if user == current_user:
             flash(_('You cannot follow yourself!'))
-            return redirect(url_for('main.user', username=username))
+            return _follow_redirect(url_for('main.user', username=username))
         current_user.follow(user)
         db.session.commit()
+        fragment = _follow_fragment(user)
+        if fragment is not None:
+            return fragment
         flash(_('You are now following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('main.index'))
+        return _follow_redirect(url_for('main.index'))
     
 @bp.route('/unfollow/<username>', methods=['POST'])
 @login_required
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = db.session.scalar(sa.select(User).where(User.username == username))
+        user = _get_user_by_username(username)
         if user is None:
             flash(_('User %(username)s not found', username=username))
-            return redirect(url_for('main.index'))
+            return _follow_redirect(url_for('main.index'))
         if user == current_user:
             flash(_('You cannot unfollow yourself!'))
-            return redirect(url_for('main.user', username=username))
+            return _follow_redirect(url_for('main.user', username=username))
         current_user.unfollow(user)
         db.session.commit()
+        fragment = _follow_fragment(user)
+        if fragment is not None:
+            return fragment
         flash(_('You successfully unfollowed %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
-        return redirect(url_for('main.index'))
+        return _follow_redirect(url_for('main.index'))
 
 @bp.route('/search')
 @login_required
 def search():
     # use form.validate() because form.validate_on_submit() only works for POST request forms
-    if not g.search_form.validate():
+    search_form = get_search_form()
+    if not search_form.validate():
         return redirect(url_for('main.explore'))
     
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) if page > 1 else None
+    posts, total = Post.search(search_form.q.data, page, current_app.config['POSTS_PER_PAGE'])
+    next_url = url_for('main.search', q=search_form.q.data, page=page + 1) if total > page * current_app.config['POSTS_PER_PAGE'] else None
+    prev_url = url_for('main.search', q=search_form.q.data, page=page - 1) if page > 1 else None
     return render_template('search.html', title=_('Search'), posts=posts, next_url=next_url, prev_url=prev_url)
 
 """ send private/direct messages to user with username <recipient> """
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = db.first_or_404(sa.select(User).where(User.username == recipient))
+    user = _get_user_by_username(recipient)
+    if user is None:
+        abort(404)
     form = MessageForm()
     if form.validate_on_submit():
+        # count the unread messages before adding the new one (the new message is always unread, hence the + 1),
+        # this way the count query doesn't have to flush the new message first, and everything is written in the one commit
+        unread_message_count = user.unread_message_count() + 1
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.unread_message_count())
+        user.add_notification('unread_message_count', unread_message_count)
         db.session.commit()
         flash(_('Your message has been sent'))
         return redirect(url_for('main.user', username=recipient))
@@ -176,24 +304,97 @@ def send_message(recipient):
 @bp.route('/view_message')
 @login_required
 def view_message():
-    current_user.last_message_read_time = datetime.now(timezone.utc)
-    current_user.add_notification('unread_message_count', 0)
+    # the notification is already 0 when there was nothing unread, then opening the messages writes nothing to the database
+    if current_user.unread_message_count():
+        current_user.add_notification('unread_message_count', 0)
+    current_user.set_last_message_read_time(datetime.now(timezone.utc))
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    messages = db.paginate(query, page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.view_message', page=messages.next_num) if messages.has_next else None
-    prev_url = url_for('main.view_message', page=messages.prev_num) if messages.has_prev else None
-    return render_template('view_message.html', title=_('View message'), messages=messages.items, next_url=next_url, prev_url=prev_url)
+    current_user.forget_unread_message_count()
+    query = current_user.messages_received.select().options(so.selectinload(Message.author)).order_by(Message.timestamp.desc())
+    messages, next_url = _feed_page(query, Message, 'main.view_message')
+    return render_template('view_message.html', title=_('View message'), messages=messages, next_url=next_url)
+
+""" the current user's notifications matching condition, as the list of dicts returned by /notifications and /bfetch """
+def _get_notifications(condition):
+    # this is polled by every open page, so only the 3 columns needed are selected (no Notification objects are built)
+    # and the payload comes out of the JSON column already decoded, yield_per streams the rows instead of loading them all at once
+    query = (
+        sa.select(Notification.name, Notification.payload, Notification.timestamp)
+        .where(condition)
+        .order_by(Notification.timestamp.asc())
+        .execution_options(yield_per=200)
+    )
+    return [{'name': name, 'data': payload, 'timestamp': timestamp}
+            for name, payload, timestamp in db.session.execute(query)]
 
 """ displays notifications to users """
 @bp.route('/notifications')
 @login_required
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    query = current_user.notifications.select().where(Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
-    return [{'name': n.name, 'data': n.get_data(), 'timestamp': n.timestamp} for n in notifications]
+    condition = sa.and_(Notification.user_id == current_user.id, Notification.timestamp > since)
+    # add_notification() always replaces a notification with a newer one, so the newest timestamp and the number of
+    # notifications change whenever the response would change, which makes them a cheap ETag for the conditional GET:
+    # when the browser already has this response (If-None-Match), a 304 with no body is returned without loading anything
+    latest, count = db.session.execute(sa.select(sa.func.max(Notification.timestamp), sa.func.count()).where(condition)).one()
+    etag = f'{current_user.id}-{latest}-{count}'
+    # Flask-Compress appends the encoding to the ETag of a compressed response (W/"...:gzip"),
+    # and that is the ETag the browser sends back, so the suffixed ETags match as well
+    etags = [etag] + [f'{etag}:{algorithm}' for algorithm in compress.enabled_algorithms]
+    if any(request.if_none_match.contains_weak(tag) for tag in etags):
+        response = current_app.response_class(status=304)
+    else:
+        # encoded with orjson directly (the timestamps are floats, which orjson encodes natively), skipping app.json altogether
+        response = current_app.response_class(orjson.dumps(_get_notifications(condition)), mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    # the browser may keep the response but has to check with the server (and get the 304) before reusing it
+    response.headers['Cache-Control'] = 'private, max-age=0, must-revalidate'
+    return response
+
+""" the endpoints that can be batched through /bfetch, each one takes the params dict of the sub-request """
+_BFETCH_ENDPOINTS = {
+    'notifications': lambda params: _get_notifications(sa.and_(
+        Notification.user_id == current_user.id, Notification.timestamp > float(params.get('since', 0.0)))),
+}
+
+"""
+batches several polling requests into one HTTP round-trip:
+- the body is {"requests": [{"id": ..., "endpoint": "notifications", "params": {"since": ...}}, ...]}
+- the response is streamed as NDJSON, one {"id": ..., "result": ...} (or "error") line per sub-request as soon as it's done,
+  and the client matches the lines to its sub-requests with the id
+"""
+@bp.route('/bfetch', methods=['POST'])
+@login_required
+def bfetch():
+    # the shape of the body is checked before streaming starts, an error after the first line would break the stream
+    # each sub-request runs its own queries, so their number is capped
+    body = request.get_json(silent=True) or {}
+    if not isinstance(body, dict) or not isinstance(body.get('requests') or [], list):
+        abort(400)
+    sub_requests = body.get('requests') or []
+    if len(sub_requests) > current_app.config['BFETCH_MAX_REQUESTS']:
+        abort(400)
+    def generate():
+        for sub_request in sub_requests:
+            if not isinstance(sub_request, dict):
+                yield orjson.dumps({'id': None, 'error': 'invalid request'}) + b'\n'
+                continue
+            endpoint = sub_request.get('endpoint')
+            # a list or an object can't be looked up in the dict
+            handler = _BFETCH_ENDPOINTS.get(endpoint) if isinstance(endpoint, str) else None
+            params = sub_request.get('params') or {}
+            if handler is None:
+                line = {'id': sub_request.get('id'), 'error': 'unknown endpoint'}
+            elif not isinstance(params, dict):
+                line = {'id': sub_request.get('id'), 'error': 'invalid params'}
+            else:
+                try:
+                    line = {'id': sub_request.get('id'), 'result': handler(params)}
+                except (TypeError, ValueError):
+                    line = {'id': sub_request.get('id'), 'error': 'invalid params'}
+            yield orjson.dumps(line) + b'\n'
+    # stream_with_context keeps the request (and so current_user and the database session) around while streaming
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 """ export a json file of all the posts made by the user, handled as a background job/task """
 @bp.route('/export_posts')
@@ -1,17 +1,40 @@
 """ database model/schema/structure """
 from datetime import datetime, timezone, timedelta
-from typing import Optional
+from typing import Any, Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from app import db, login
 from flask import current_app, url_for
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
+from functools import cached_property
 from time import time
-import jwt, json, redis, rq
-from app.search import add_to_index, remove_from_index, query_index
+import jwt, redis, rq
+from app.search import bulk_index, apply_changes, query_index
 import secrets
+from itsdangerous import URLSafeSerializer
+
+"""
+a DateTime column that always gives back timezone aware datetimes in UTC
+- SQLite and MySQL don't store a timezone, so datetimes come back naive from them and every read needed .replace(tzinfo=timezone.utc),
+  now that is done once here for all the datetime columns, and aware datetimes are converted to naive UTC before being stored
+- the column in the database is still a plain DateTime, so no migration is needed
+"""
+class UTCDateTime(sa.TypeDecorator):
+    impl = sa.DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
 
 """ 
 act as a "glue" layer between the SQLAlchemy and Elasticsearch worlds, 
@@ -25,11 +48,21 @@ class SearchableMixin:
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
         if total == 0:
             return [], 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
         # queries the list of IDs as their respective objects while maintaining their order
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(db.case(*when, value=cls.id))
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # joined with a VALUES list of (id, position), which stays the same size as the list of ids, unlike
+            # the CASE below that needs one WHEN per id
+            ordering = sa.values(
+                sa.column('id', sa.Integer), sa.column('position', sa.Integer), name='ordering'
+            ).data([(id, i) for i, id in enumerate(ids)])
+            query = sa.select(cls).join(ordering, ordering.c.id == cls.id).order_by(ordering.c.position)
+        else:
+            # other databases have no (or a different) syntax for a VALUES list in a FROM clause
+            when = [(id, i) for i, id in enumerate(ids)]
+            query = sa.select(cls).where(cls.id.in_(ids)).order_by(db.case(*when, value=cls.id))
+        # searchable models with an author (posts) get their authors in one extra query instead of one lazy query per result
+        if hasattr(cls, 'author'):
+            query = query.options(so.selectinload(cls.author))
         # returns the list of IDs as their respective objects and total number of search results
         return db.session.scalars(query), total
 
@@ -42,20 +75,28 @@ class SearchableMixin:
             'delete': list(session.deleted)
         }
 
-    """ uses the saved objects above to update Elasticsearch index to prevent desync between SQLAlchemy & Elasticsearch """
+    """ 
+    uses the saved objects above to update Elasticsearch index to prevent desync between SQLAlchemy & Elasticsearch,
+    the update itself runs as a background task so the request that committed doesn't wait for Elasticsearch
+    """
     @classmethod
     def after_commit(cls, session):
-        # loops because it's a list of objects
-        for obj in session._changes['add']:
+        # the documents are built now, so the background task only has to send them and doesn't need to read the database
+        changes = []
+        for obj in session._changes['add'] + session._changes['update']:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
+                payload = {field: getattr(obj, field) for field in obj.__searchable__}
+                changes.append((obj.__tablename__, obj.id, 'index', payload))
         for obj in session._changes['delete']:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
+                changes.append((obj.__tablename__, obj.id, 'delete', None))
         session._changes = None
+        if changes and current_app.elasticsearch:
+            try:
+                current_app.task_queue.enqueue('app.tasks.index_changes', changes, job_timeout=60)
+            except redis.exceptions.RedisError:
+                # no Redis to queue the task on, so update the index right away instead
+                apply_changes(changes)
 
     """ 
     re-sends all database rows of a model to Elasticsearch so it knows which fields to search, 
@@ -64,8 +105,14 @@ class SearchableMixin:
     """
     @classmethod
     def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+        # only the id and the searchable columns are selected, as plain rows without building a model object for each of them
+        # stream_results with yield_per reads the rows 1000 at a time (server side cursor), and bulk_index() sends them in chunks
+        # as they're read, so the whole table is never in memory at once
+        query = (
+            sa.select(cls.id, *[getattr(cls, field) for field in cls.__searchable__])
+            .execution_options(stream_results=True, yield_per=1000)
+        )
+        bulk_index(cls.__tablename__, db.session.execute(query), cls.__searchable__)
 
 """  
 set up the event handlers that will make SQLAlchemy call the before_commit() and after_commit() methods
@@ -75,26 +122,84 @@ db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 class PaginatedAPIMixin(object):
-    """ converts a paginated SQLAlchemy query result (e.g. a list of User or Post objects) into a Python dictionary """
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
-        resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
+    """ hook to load extra data for a whole page of items at once before to_dict() is called on each of them """
+    @classmethod
+    def bulk_augment(cls, items):
+        pass
+
+    """ 
+    converts a paginated SQLAlchemy query result (e.g. a list of User or Post objects) into a Python dictionary
+    - with count=False the COUNT(*) of the whole query is skipped (often the slowest part on big tables), so _meta has no
+      total_pages or total_items, and one extra item is fetched only to tell whether there is a next page
+    """
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, count=True, **kwargs):
+        # same as db.paginate(), which treats a page or per_page below 1 as the defaults
+        page, per_page = max(page, 1), per_page if per_page > 0 else 20
+        meta = {'page': page, 'per_page': per_page}
+        if count:
+            resources = db.paginate(query, page=page, per_page=per_page, error_out=False)
+            items, has_next, has_prev = resources.items, resources.has_next, resources.has_prev
+            meta.update(total_pages=resources.pages, total_items=resources.total)
+        else:
+            items = db.session.scalars(query.limit(per_page + 1).offset((page - 1) * per_page)).all()
+            has_next, has_prev = len(items) > per_page, page > 1
+            items = items[:per_page]
+            # the links keep asking for pages without the count
+            kwargs['count'] = 'false'
+        cls.bulk_augment(items)
         data = {
-            'items': [item.to_dict() for item in resources.items],
-            '_meta': {
-                'page': page,
-                'per_page': per_page,
-                'total_pages': resources.pages,
-                'total_items': resources.total
-            },
+            'items': [item.to_dict() for item in items],
+            '_meta': meta,
             '_links': {
                 'self': url_for(endpoint, page=page, per_page=per_page, **kwargs),
-                'next': url_for(endpoint, page=page + 1, per_page=per_page, **kwargs) if resources.has_next else None,
-                'prev': url_for(endpoint, page=page - 1, per_page=per_page, **kwargs) if resources.has_prev else None
+                'next': url_for(endpoint, page=page + 1, per_page=per_page, **kwargs) if has_next else None,
+                'prev': url_for(endpoint, page=page - 1, per_page=per_page, **kwargs) if has_prev else None
             }
         }
         return data
 
+"""
+keyset (seek) pagination for the lists shown newest first (posts, messages):
+- instead of a page number (OFFSET, which makes the database go through all the rows of the previous pages, plus a COUNT(*)),
+  the next page starts right after the (timestamp, id) of the last item of the current page
+- the id breaks ties between items with the same timestamp, so no item is skipped or shown twice
+- the (timestamp, id) is sent to the browser as a signed cursor, so it can't be tampered with
+"""
+class FeedMixin:
+    @staticmethod
+    def _cursor_serializer():
+        return URLSafeSerializer(current_app.config['SECRET_KEY'], salt='feed-cursor')
+
+    """
+    the conditions for the items after (timestamp, id), in (timestamp, id) descending order, or ascending if descending=False
+    - the first bound (timestamp <= for descending) is redundant for the result, but databases can't turn the OR alone into a range
+      of the timestamp index, without it every page would still go through all the rows before it
+    """
+    @classmethod
+    def after(cls, timestamp, id, descending=True):
+        if descending:
+            return (cls.timestamp <= timestamp,
+                    sa.or_(cls.timestamp < timestamp, sa.and_(cls.timestamp == timestamp, cls.id < id)))
+        return (cls.timestamp >= timestamp,
+                sa.or_(cls.timestamp > timestamp, sa.and_(cls.timestamp == timestamp, cls.id > id)))
+
+    """ returns the items of the page after cursor (first page if None) and the cursor of the next page (None if last page) """
+    @classmethod
+    def feed_page(cls, query, cursor=None, per_page=25):
+        query = query.order_by(None).order_by(cls.timestamp.desc(), cls.id.desc())
+        if cursor is not None:
+            # raises itsdangerous.BadSignature if the cursor was not made by us
+            timestamp, id = cls._cursor_serializer().loads(cursor)
+            query = query.where(*cls.after(datetime.fromisoformat(timestamp), id))
+        # one more item than needed, it's only there to tell whether there is a next page
+        items = db.session.scalars(query.limit(per_page + 1)).all()
+        next_cursor = None
+        if len(items) > per_page:
+            items = items[:per_page]
+            next_cursor = cls._cursor_serializer().dumps([items[-1].timestamp.isoformat(), items[-1].id])
+        return items, next_cursor
+
 """
 - use columns because the association table looks sth like this
            followers
@@ -112,7 +217,10 @@ followers = sa.Table(
     # neither columns will have unique values to make primary key, but the pair of foreign keys combined is unique
     # so we make both columns primary_key=True, this is also called compound primary key
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
-    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True)
+    sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'), primary_key=True),
+    # the primary key starts with follower_id, so it's only useful for "who does this user follow",
+    # this index is the other way around for "who follows this user" (followers lists and counts)
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
 )
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
@@ -136,10 +244,10 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     # here the Post class isn't defined yet so we use 'Post' instead, this is called forward reference
     posts: so.WriteOnlyMapped['Post'] = so.relationship(back_populates='author')
     about_me: so.Mapped[Optional[str]] = so.mapped_column(sa.String(140))
-    last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(default=lambda: datetime.now(timezone.utc))
-    last_message_read_time: so.Mapped[Optional[datetime]]
+    last_seen: so.Mapped[Optional[datetime]] = so.mapped_column(UTCDateTime, default=lambda: datetime.now(timezone.utc))
+    last_message_read_time: so.Mapped[Optional[datetime]] = so.mapped_column(UTCDateTime)
     token: so.Mapped[Optional[str]] = so.mapped_column(sa.String(32), index=True, unique=True)
-    token_expiration: so.Mapped[Optional[datetime]]
+    token_expiration: so.Mapped[Optional[datetime]] = so.mapped_column(UTCDateTime)
 
     # secondary is the association table
     # primaryjoin is the condition that links our side to the association table
@@ -182,9 +290,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    # the avatar is rendered next to every post of a page, so the md5 of the email is only computed once per User object
+    # (forgotten when the email changes, see _forget_avatar_digest() below)
+    @cached_property
+    def _avatar_digest(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return f'https://www.gravatar.com/avatar/{self._avatar_digest}?d=identicon&s={size}'
         # return f'https://www.shutterstock.com/image-vector/default-avatar-profile-icon-social-600nw-1677509740.jpg?s={size}'
 
     # following and followers are columns of the User table defined above
@@ -196,10 +309,11 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         if self.is_following(user):
             self.following.remove(user)
     
-    # .select() is exclusive to WriteOnlyMapped
+    # a lookup of one row of the "followers" association table by its primary key (follower_id, followed_id),
+    # instead of self.following.select() which joins the user table and loads the followed User
     def is_following(self, user):
-        query = self.following.select().where(User.id == user.id)
-        return db.session.scalar(query) is not None
+        query = sa.select(sa.exists().where(followers.c.follower_id == self.id, followers.c.followed_id == user.id))
+        return db.session.scalar(query)
 
     def followers_count(self):
         query = sa.select(sa.func.count()).select_from(self.followers.select().subquery())
@@ -209,42 +323,22 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         query = sa.select(sa.func.count()).select_from(self.following.select().subquery())
         return db.session.scalar(query)
 
-    # because both authors and followers are of class 'User', we need aliases to independently refer to them without errors
-
-    # first we select all from Post table
-
-    # then first join, we join Post with Post.author, which basically is the same as join Post and User where post.user_id == user.id
-    # now due to the of_type(Author) from previous join, for the rest of the query I'm going to refer to the right side entity of the 
-    # relationship (Left: Post, Right: User, Right side is merged into Left side) with the "Author" alias
-
-    # second join, we join the current combined temporary table with Author.followers, with "Author" being the alias for User defined 
-    # above the users added to the combined table will then use the "Follower" alias (matching Author.id and Follower.id from the 
-    # "followers" association table)
-
-    # remaining filters are mostly self-explanatory
-
-    # isouter=True makes the second join a left outer join instead of inner join, 
-    # plus the sa.or_(Follower.id == self.id, Author.id == self.id) both combine to make sure that the author's own posts are also included
-
-    # group_by groups identical values together based on 1 or more columns selected, so in the case with no aggregate functions 
-    # it removes duplicates
-    # note that for example, when I pass Post as an argument, SQLAlchemy will interpret as all the attributes of the model/class
-
-    # even though the combined temporary table is larger than what was created by the database as part of this query
-    # the result will just be the posts that are included in this temporary table, as the query was issued on the Post class
+    # the posts of the user itself, plus the posts whose author is followed by the user
+    # - the follow check is an EXISTS on the "followers" association table (a lookup on its primary key per post), so there is
+    #   no join that needs to be de-duplicated afterwards with a GROUP BY (which aggregated the whole joined set on every request)
+    # - sa.select(1)...exists() is turned by SQLAlchemy into a correlated subquery, i.e. it uses the Post.user_id of the outer row
     def following_posts(self):
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
+        is_followed = (
+            sa.select(1).select_from(followers)
+            .where(followers.c.follower_id == self.id, followers.c.followed_id == Post.user_id)
+            .exists()
+        )
         return (
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
-            .where(sa.or_(
-                Follower.id == self.id,
-                Author.id == self.id
-            ))
-            .group_by(Post)
+            .where(sa.or_(Post.user_id == self.id, is_followed))
             .order_by(Post.timestamp.desc())
+            # the authors of the posts are loaded in one extra query instead of one lazy query per post when rendered
+            .options(so.selectinload(Post.author))
         )
 
     # 10 minutes until expiration
@@ -265,16 +359,67 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.get(User, id)
     
     """ returns the number of unread messages the user has """
+    # the count is shown on every page, so it's cached in redis for a short time (the database is used if redis is unreachable)
+    # - forgotten when a message is sent to the user (see _forget_unread_message_count() below) and when they read their messages
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
+        key = f'unread:{self.id}'
+        try:
+            cached = current_app.redis.get(key)
+        except redis.exceptions.RedisError:
+            cached = None
+        if cached is not None:
+            return int(cached)
+        last_read_time = self.get_last_message_read_time() or datetime(1900, 1, 1)
         query = sa.select(Message).where(Message.recipient == self, Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+        count = db.session.scalar(sa.select(sa.func.count()).select_from(query.subquery()))
+        try:
+            current_app.redis.setex(key, current_app.config['UNREAD_MESSAGE_COUNT_CACHE_TIMEOUT'], count)
+        except redis.exceptions.RedisError:
+            pass
+        return count
+
+    def forget_unread_message_count(self):
+        _redis_delete(f'unread:{self.id}')
+
+    """
+    the time the user last read their messages is kept in redis (the user:{id} hash), so that opening the messages page doesn't
+    need a database write, the last_message_read_time column is only used when redis is unreachable (and for older read times)
+    """
+    def get_last_message_read_time(self):
+        try:
+            read_time = current_app.redis.hget(f'user:{self.id}', 'last_msg_read_ts')
+        except redis.exceptions.RedisError:
+            read_time = None
+        if read_time is not None:
+            return datetime.fromisoformat(read_time.decode())
+        return self.last_message_read_time
+
+    def set_last_message_read_time(self, read_time):
+        try:
+            current_app.redis.hset(f'user:{self.id}', 'last_msg_read_ts', read_time.isoformat())
+        except redis.exceptions.RedisError:
+            self.last_message_read_time = read_time
 
+    # a user has at most one notification of each name (unique constraint on user_id, name), so instead of deleting the old one
+    # and inserting the new one (two statements), the notification is inserted or updated in place with one upsert statement
+    # - the upsert syntax is different for each database, the ones without (or unknown) fall back to delete + insert
     def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        values = {'user_id': self.id, 'name': name, 'payload': data, 'timestamp': time()}
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+            query = insert(Notification).values(values)
+            query = query.on_conflict_do_update(
+                index_elements=['user_id', 'name'],
+                set_={'payload': query.excluded.payload, 'timestamp': query.excluded.timestamp}
+            )
+        elif dialect in ('mysql', 'mariadb'):
+            query = mysql.insert(Notification).values(values)
+            query = query.on_duplicate_key_update(payload=query.inserted.payload, timestamp=query.inserted.timestamp)
+        else:
+            db.session.execute(self.notifications.delete().where(Notification.name == name))
+            query = sa.insert(Notification).values(values)
+        db.session.execute(query)
     
     """ helper methods for submitting a background job/task or checking on a task from any part of the application """
     """ submit a background job/task to rq queue and add a Task instance to the database """
@@ -282,32 +427,101 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task)
+        try:
+            current_app.redis.sadd(f'tasks_in_progress:{self.id}', task.id)
+        except redis.exceptions.RedisError:
+            pass
         return task
 
+    """ 
+    the ids of the tasks in progress are kept in a redis set, so the pages (which all show the tasks in progress) don't need to
+    query the tasks when there are none, which is most of the time
+    - the set always has an extra '' member once it's loaded from the database, because redis doesn't keep empty sets and
+      a missing set must be told apart from a user without tasks in progress
+    - returns None if redis is unreachable
+    """
+    def _task_ids_in_progress(self):
+        key = f'tasks_in_progress:{self.id}'
+        try:
+            ids = current_app.redis.smembers(key)
+            if b'' not in ids:
+                query = sa.select(Task.id).where(Task.user_id == self.id, Task.complete == False)
+                ids = {b''} | ids | {id.encode() for id in db.session.scalars(query)}
+                # the set expires from time to time, in case a task died without ever removing itself
+                current_app.redis.pipeline().sadd(key, *ids).expire(key, 3600).execute()
+        except redis.exceptions.RedisError:
+            return None
+        return ids - {b''}
+
+    """ removes a completed task from the tasks in progress in redis, called after the task is committed as complete """
+    def forget_task_in_progress(self, task_id):
+        try:
+            current_app.redis.srem(f'tasks_in_progress:{self.id}', task_id)
+        except redis.exceptions.RedisError:
+            pass
+
     """ returns a list of all tasks in progress """
     def get_tasks_in_progress(self):
+        if self._task_ids_in_progress() == set():
+            return []
         query = self.tasks.select().where(Task.complete == False)
         return db.session.scalars(query)
 
     """ check if a certain task is in progress or not """
     def get_task_in_progress(self, name):
+        if self._task_ids_in_progress() == set():
+            return None
         query = self.tasks.select().where(Task.name == name, Task.complete == False)
         return db.session.scalar(query)
     
     def posts_count(self):
         query = sa.select(sa.func.count()).select_from(self.posts.select().subquery())
         return db.session.scalar(query)
+
+    """ the posts, followers and following counts of the user in a single query instead of one query per count """
+    def counts(self):
+        query = sa.select(
+            sa.select(sa.func.count(Post.id)).where(Post.user_id == self.id).scalar_subquery().label('posts'),
+            sa.select(sa.func.count()).select_from(followers).where(followers.c.followed_id == self.id).scalar_subquery().label('followers'),
+            sa.select(sa.func.count()).select_from(followers).where(followers.c.follower_id == self.id).scalar_subquery().label('following')
+        )
+        return db.session.execute(query).one()._asdict()
+
+    """ 
+    counts of a whole page of users (see to_collection_dict()) in one query, grouped by user id, 
+    instead of 3 count queries for every user, the counts are kept on each user until its to_dict() is called
+    """
+    @classmethod
+    def bulk_augment(cls, users):
+        ids = [user.id for user in users]
+        if not ids:
+            return
+        query = sa.union_all(
+            sa.select(Post.user_id, sa.literal('posts'), sa.func.count())
+                .where(Post.user_id.in_(ids)).group_by(Post.user_id),
+            sa.select(followers.c.followed_id, sa.literal('followers'), sa.func.count())
+                .where(followers.c.followed_id.in_(ids)).group_by(followers.c.followed_id),
+            sa.select(followers.c.follower_id, sa.literal('following'), sa.func.count())
+                .where(followers.c.follower_id.in_(ids)).group_by(followers.c.follower_id)
+        )
+        counts = {id: {'posts': 0, 'followers': 0, 'following': 0} for id in ids}
+        for id, name, count in db.session.execute(query):
+            counts[id][name] = count
+        for user in users:
+            user._counts = counts[user.id]
     
     """ converts a model instance (e.g. User or Post) into a Python representation (dictionary), which will then be converted to JSON """
     def to_dict(self, include_email=False):
+        # the counts from bulk_augment() are only used once, so they can't go stale
+        counts = self.__dict__.pop('_counts', None) or self.counts()
         data = {
             'id': self.id,
             'username': self.username,
-            'last_seen': self.last_seen.replace(tzinfo=timezone.utc).isoformat() if self.last_seen else None,
+            'last_seen': self.last_seen.isoformat() if self.last_seen else None,
             'about_me': self.about_me,
-            'posts_count': self.posts_count(),
-            'followers_count': self.followers_count(),
-            'following_count': self.following_count(),
+            'posts_count': counts['posts'],
+            'followers_count': counts['followers'],
+            'following_count': counts['following'],
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -332,7 +546,7 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     """ generate a temporary token for API authentication purposes """
     def get_token(self, expires_in=3600):
         now = datetime.now(timezone.utc)
-        if self.token and self.token_expiration.replace(tzinfo=timezone.utc) > now + timedelta(seconds=60):
+        if self.token and self.token_expiration > now + timedelta(seconds=60):
             return self.token
         self.token = secrets.token_hex(16)
         self.token_expiration = now + timedelta(seconds=expires_in)
@@ -345,33 +559,50 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     @staticmethod
     def check_token(token):
         user = db.session.scalar(sa.select(User).where(User.token == token))
-        if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < datetime.now(timezone.utc):
+        if user is None or user.token_expiration < datetime.now(timezone.utc):
             return None
         return user
 
+""" forget the cached avatar digest when the email is set, or when it could have been reloaded from the database """
+def _forget_avatar_digest(target, *args):
+    target.__dict__.pop('_avatar_digest', None)
+
+db.event.listen(User.email, 'set', _forget_avatar_digest)
+db.event.listen(User, 'expire', _forget_avatar_digest)
+
+def _redis_delete(key):
+    try:
+        current_app.redis.delete(key)
+    except redis.exceptions.RedisError:
+        pass
+
 @login.user_loader
 def load_user(id): # id passed in here is string so we want to convert back to int for our database
     return db.session.get(User, int(id))
 
-class Post(SearchableMixin, db.Model):
+class Post(FeedMixin, SearchableMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
-    timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
+    timestamp: so.Mapped[datetime] = so.mapped_column(UTCDateTime, index=True, default=lambda: datetime.now(timezone.utc))
     # one-to-many relationship so we have to make user_id column foreign key
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     author: so.Mapped[User] = so.relationship(back_populates='posts')
     __searchable__ = ['body'] # can only add direct fields like body, timestamp, id, user_id, etc.
+    # the profile page lists one user's posts newest first, with this index the database reads them straight from the index
+    # in order instead of finding all the user's posts and then sorting them
+    # (the explore page uses the timestamp index, which databases can read backwards for the newest first order)
+    __table_args__ = (sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),)
 
     def __repr__(self):
         return f'<Post {self.body}>'
 
 """ Message model to extend the database to support private/direct messaging """    
-class Message(db.Model):
+class Message(FeedMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
-    timestamp: so.Mapped[datetime] = so.mapped_column(index=True, default=lambda: datetime.now(timezone.utc))
+    timestamp: so.Mapped[datetime] = so.mapped_column(UTCDateTime, index=True, default=lambda: datetime.now(timezone.utc))
 
     # because there are two foreign keys pointing to the same User table, 
     # SQLAlchemy needs help understanding which field maps to which relationship
@@ -381,20 +612,33 @@ class Message(db.Model):
     author: so.Mapped[User] = so.relationship(foreign_keys='Message.sender_id', back_populates='messages_sent')
     recipient: so.Mapped[User] = so.relationship(foreign_keys='Message.recipient_id', back_populates='messages_received')
 
+    # the unread message count (recipient_id = ? AND timestamp > ?) and the list of received messages (newest first)
+    # are both a range of this index
+    __table_args__ = (sa.Index('ix_message_recipient_id_timestamp', 'recipient_id', 'timestamp'),)
+
     def __repr__(self):
         return f'<Message {self.body}>'
     
+""" a new message changes the unread message count of its recipient """
+def _forget_unread_message_count(mapper, connection, target):
+    _redis_delete(f'unread:{target.recipient_id}')
+
+db.event.listen(Message, 'after_insert', _forget_unread_message_count)
+
 """ Notification model to keep track of notifications for all users """
 class Notification(db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id), index=True)
     timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
-    payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
+    # a JSON column (JSONB on PostgreSQL) so the data is given and returned as Python objects, parsed by the database driver
+    payload: so.Mapped[Any] = so.mapped_column(sa.JSON().with_variant(postgresql.JSONB(), 'postgresql'))
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
+    __table_args__ = (sa.UniqueConstraint('user_id', 'name', name='uq_notification_user_id_name'),)
+
     def get_data(self):
-        return json.loads(str(self.payload_json))
+        return self.payload
     
 """ Task model to keep track of background jobs/tasks """
 class Task(db.Model):
@@ -1,30 +1,75 @@
 """ module with all the Elasticsearch (or any search engines) code for full-text search feature """
 from flask import current_app
+from elasticsearch import helpers
+import hashlib, json, redis
 
-""" add entries to a full-text index for searching """
-# model is SQLAlchemy model
-# model.id is the id field of the SQLAlchemy model
-# using the same id value for SQLAlchemy and Elasticsearch is very useful when running the searches, 
-# as it allows me to link entries in the two databases
-def add_to_index(index, model):
+"""
+search results are cached in Redis for SEARCH_CACHE_TIMEOUT seconds, since popular searches are repeated a lot
+- the key includes a version number of the index, every change to the index bumps the version (see invalidate_search_cache),
+  so cached results never outlive a change, the old keys just expire
+- if Redis is not available, the search simply goes to Elasticsearch every time
+"""
+def _search_cache_key(index, query, page, per_page):
+    version = current_app.redis.get(f'search:{index}:version') or b'0'
+    digest = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    return f'search:{index}:{version.decode()}:{digest}:{page}:{per_page}'
+
+def invalidate_search_cache(index):
+    if not current_app.elasticsearch:
+        return
+    try:
+        current_app.redis.incr(f'search:{index}:version')
+    except redis.exceptions.RedisError:
+        pass
+
+"""
+add entries to a full-text index for searching, one HTTP request to Elasticsearch per chunk of 2000 documents
+- using the same id value for SQLAlchemy and Elasticsearch is very useful when running the searches,
+  as it allows me to link entries in the two databases, if the id already exists, Elasticsearch replaces the old entry
+- rows can be any iterable (e.g. a generator) of objects with an id and the given fields as attributes (models or result rows),
+  it's consumed chunk by chunk so not everything has to be in memory at once
+"""
+def bulk_index(index, rows, fields):
     if not current_app.elasticsearch:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    # if id already exists, Elasticsearch replaces old entry with new entry
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    actions = ({'_op_type': 'index', '_index': index, '_id': row.id,
+                '_source': {field: getattr(row, field) for field in fields}} for row in rows)
+    helpers.bulk(current_app.elasticsearch.options(request_timeout=60), actions, chunk_size=2000)
 
-""" remove entries from the index """
-def remove_from_index(index, model):
+"""
+applies a list of (index, id, op, payload) changes to Elasticsearch in bulk, where op is 'index' (payload is the document)
+or 'delete' (payload is None), called by the index_changes background task (see SearchableMixin.after_commit)
+"""
+def apply_changes(changes):
     if not current_app.elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    actions = []
+    for index, id, op, payload in changes:
+        action = {'_op_type': op, '_index': index, '_id': id}
+        if op == 'index':
+            action['_source'] = payload
+        actions.append(action)
+    # a bulk request can mix several indexes, 404 means a deleted document was already not in the index
+    # refresh='wait_for' only returns once the changes are visible to searches, otherwise a search between the bulk request
+    # and the next refresh of the index would cache the old results under the new version below
+    helpers.bulk(current_app.elasticsearch.options(request_timeout=60), actions, chunk_size=2000, ignore_status=(404,),
+                 refresh='wait_for')
+    # cached search results of the changed indexes are now outdated
+    for index in {change[0] for change in changes}:
+        invalidate_search_cache(index)
 
 """ execute a search query to search stuffs """
 def query_index(index, query, page, per_page):
     if not current_app.elasticsearch:
         return [], 0
+    try:
+        key = _search_cache_key(index, query, page, per_page)
+        cached = current_app.redis.get(key)
+    except redis.exceptions.RedisError:
+        key = cached = None
+    if cached:
+        ids, total = json.loads(cached)
+        return ids, total
     search = current_app.elasticsearch.search(
         index=index,
         # multi_match allows searching across multiple fields
@@ -36,5 +81,11 @@ def query_index(index, query, page, per_page):
         from_=(page - 1) * per_page,
         size=per_page)
     ids = [int(hit['_id']) for hit in search['hits']['hits']]
+    total = search['hits']['total']['value']
+    if key:
+        try:
+            current_app.redis.setex(key, current_app.config['SEARCH_CACHE_TIMEOUT'], json.dumps([ids, total]))
+        except redis.exceptions.RedisError:
+            pass
     # ids of the returned search results, total number of results
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    return ids, total
\ No newline at end of file
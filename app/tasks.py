@@ -8,9 +8,11 @@ from app import create_app, db
 from app.models import Task, User, Post
 import sys
 import sqlalchemy as sa
-import json
+import orjson
+import tempfile
 from flask import render_template
-from app.email import send_email
+from app.email import send_email, send_email_batch
+from app.search import apply_changes
 
 app = create_app()
 app.app_context().push()
@@ -27,9 +29,28 @@ def example(seconds):
     job.save_meta()
     print('Task completed')
 
+""" sends an email queued by send_email() on the task queue, exceptions are left to rq so the job gets retried """
+def send_email_task(subject, sender, recipients, text_body, html_body, attachments=None):
+    send_email(subject, sender=sender, recipients=recipients, text_body=text_body, html_body=html_body,
+               attachments=attachments, sync=True)
+
+""" sends a batch of emails queued by send_email_batch() over one SMTP connection """
+def send_email_batch_task(emails):
+    send_email_batch(emails, sync=True)
+
+""" sends the search index changes of a commit to Elasticsearch, queued by SearchableMixin.after_commit() """
+def index_changes(changes):
+    apply_changes(changes)
+
+""" 
+updates the progress of the current job in rq and as a notification for the user
+- nothing is written when the progress didn't change, e.g. export_posts() sets 100 both when handling an error and when cleaning up
+"""
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
+        if job.meta.get('progress') == progress:
+            return
         job.meta['progress'] = progress
         job.save_meta()
         task = db.session.get(Task, job.get_id())
@@ -38,6 +59,27 @@ def _set_task_progress(progress):
         if progress >= 100:
             task.complete = True
         db.session.commit()
+        if progress >= 100:
+            task.user.forget_task_in_progress(task.id)
+
+"""
+the posts of a user, oldest first, in chunks of chunk_size rows
+- each chunk is its own query that starts after the (timestamp, id) of the previous chunk (keyset pagination), instead of one query
+  whose result is streamed, because _set_task_progress() commits in between, which would end a streamed result on most databases
+- only the columns needed for the export are selected, so no Post objects pile up in the session
+"""
+def _posts_in_chunks(user_id, chunk_size=500):
+    query = (
+        sa.select(Post.id, Post.body, Post.timestamp)
+        .where(Post.user_id == user_id)
+        .order_by(Post.timestamp.asc(), Post.id.asc())
+        .limit(chunk_size)
+    )
+    chunk = db.session.execute(query).all()
+    while chunk:
+        yield chunk
+        last = chunk[-1]
+        chunk = db.session.execute(query.where(*Post.after(last.timestamp, last.id, descending=False))).all()
 
 def export_posts(user_id):
     try:
@@ -45,24 +87,38 @@ def export_posts(user_id):
         # send email with data to user
         user = db.session.get(User, user_id)
         _set_task_progress(0)
-        data = []
-        posts_count = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(Post.timestamp.asc())):
-            data.append({'body': post.body, 'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            posts_count += 1
-            _set_task_progress(100 * posts_count // total_posts)
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0],
-            recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            # attachments is a list of tuples, each tuple have filename, media type, and the actual file data
-            attachments=[('posts.json', 'application/json', json.dumps({'posts': data}, indent=4))],
-            sync=True
-        )
+        # the JSON is written post by post (with orjson, much faster than json) instead of building a list of all the posts first
+        # and then dumping it as a whole, into a temporary file that stays in memory up to 16MB and moves to disk past that
+        with tempfile.SpooledTemporaryFile(max_size=16 << 20) as data:
+            data.write(b'{"posts": [')
+            posts_count = 0
+            progress = 0
+            total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(user.posts.select().subquery()))
+            for chunk in _posts_in_chunks(user_id):
+                for post in chunk:
+                    if posts_count:
+                        data.write(b',')
+                    data.write(b'\n    ')
+                    data.write(orjson.dumps({'body': post.body, 'timestamp': post.timestamp.isoformat()}))
+                    time.sleep(5)
+                    posts_count += 1
+                    # one progress update (a database commit) per percent at most, instead of one per post
+                    if 100 * posts_count // total_posts != progress:
+                        progress = 100 * posts_count // total_posts
+                        _set_task_progress(progress)
+            data.write(b'\n]}\n')
+            data.seek(0)
+            send_email(
+                '[Microblog] Your blog posts',
+                sender=app.config['ADMINS'][0],
+                recipients=[user.email],
+                text_body=render_template('email/export_posts.txt', user=user),
+                html_body=render_template('email/export_posts.html', user=user),
+                # attachments is a list of tuples, each tuple have filename, media type, and the actual file data
+                # the email is built in memory by Flask-Mail anyway, so the file is read only when it's attached
+                attachments=[('posts.json', 'application/json', data.read())],
+                sync=True
+            )
     except Exception:
         # handle unexpected errors
         _set_task_progress(100)
@@ -14,13 +14,40 @@ load_dotenv(os.path.join(basedir, '.env'))
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
+    # pool_pre_ping checks a pooled connection before using it and pool_recycle replaces connections older than 30 minutes,
+    # so connections closed by the database server (e.g. MySQL's wait_timeout) don't fail requests
+    # the pool size is only set for database servers, SQLite picks its own pool
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        **({} if SQLALCHEMY_DATABASE_URI.startswith('sqlite') else {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE') or 10),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or 10),
+        })
+    }
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS") is not None
     MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
     MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    # number of worker threads shared by all asynchronous emails, caps how many SMTP connections are open at once
+    MAIL_POOL_SIZE = int(os.environ.get('MAIL_POOL_SIZE') or 4)
     ADMINS = ['ng.minh0209@gmail.com']
     POSTS_PER_PAGE = 25
+    # how often (in seconds) the last_seen time of a user is saved to the database
+    LAST_SEEN_INTERVAL = 60
     LANGUAGES = ['en', 'es', 'vi']
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    # number of connections kept open to each Elasticsearch node
+    ELASTICSEARCH_CONNECTIONS = int(os.environ.get('ELASTICSEARCH_CONNECTIONS') or 10)
+    # how long (in seconds) search results are cached in Redis
+    SEARCH_CACHE_TIMEOUT = 60
+    # how long (in seconds) the unread message count shown on every page is cached in Redis
+    UNREAD_MESSAGE_COUNT_CACHE_TIMEOUT = 30
+    # maximum number of sub-requests in one /bfetch request
+    BFETCH_MAX_REQUESTS = 10
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    # Flask-Compress would read a streamed response (the post lists, /bfetch) to the end to compress it, which delays the first
+    # byte until the whole page is rendered, so it leaves streamed responses alone
+    # the streamed post list pages are gzipped chunk by chunk by the main blueprint instead (see _stream_page in main/routes.py)
+    COMPRESS_STREAMS = False
\ No newline at end of file
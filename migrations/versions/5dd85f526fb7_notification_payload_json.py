@@ -0,0 +1,34 @@
+"""notification payload json
+
+Revision ID: 5dd85f526fb7
+Revises: b1b9cf54b673
+Create Date: 2026-10-14 19:25:59.413570
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5dd85f526fb7'
+down_revision = 'b1b9cf54b673'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # renamed and converted in place instead of dropping and adding a column, so the existing notifications are kept
+    # (their text already is JSON, PostgreSQL needs to be told how to cast it)
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.alter_column('payload_json', new_column_name='payload', existing_nullable=False,
+                              existing_type=sa.Text(),
+                              type_=sa.JSON().with_variant(postgresql.JSONB(astext_type=sa.Text()), 'postgresql'),
+                              postgresql_using='payload_json::jsonb')
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.alter_column('payload', new_column_name='payload_json', existing_nullable=False,
+                              existing_type=sa.JSON().with_variant(postgresql.JSONB(astext_type=sa.Text()), 'postgresql'),
+                              type_=sa.Text(),
+                              postgresql_using='payload::text')
@@ -4,18 +4,24 @@ unit tests are automated tests that can be re-run anytime changes are made to ch
 """
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
-import unittest
+import gzip, json, unittest, zlib
+from unittest import mock
+import sqlalchemy as sa
 from app import create_app, db
 from app.models import User, Post
+from app.auth.forms import RegistrationForm
+from app.main.forms import EditProfileForm
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     # use in-memory SQLite database during testing instead of the database I'm using to protect that database
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # the pool options of Config are meant for DATABASE_URL, the in-memory database uses a single connection
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     ELASTICSEARCH_URL = None
 
-class UserModelCase(unittest.TestCase):
+class AppTestCase(unittest.TestCase):
     # grants Flask extensions access to Flask application instance "app" along with its configuration data
     def setUp(self):
         self.app = create_app(TestConfig)
@@ -28,7 +34,8 @@ class UserModelCase(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
-    
+
+class UserModelCase(AppTestCase):
     # unit test for each feature -> write a unit test for every feature added 
     def test_password_hashing(self):
         u = User(username='susan', email='susan@example.com')
@@ -41,6 +48,9 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
                                          'd4c74594d841139328695756648b6bd6'
                                          '?d=identicon&s=128'))
+        # the cached digest follows a change of email
+        u.email = 'susan@example.com'
+        self.assertNotIn('d4c74594d841139328695756648b6bd6', u.avatar(128))
     
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -107,5 +117,237 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counts(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.add_all([Post(body='post from john', author=u1), Post(body='another post from john', author=u1)])
+        db.session.commit()
+        u1.follow(u2)
+        u3.follow(u2)
+        u2.follow(u1)
+        db.session.commit()
+
+        self.assertEqual(u1.counts(), {'posts': 2, 'followers': 1, 'following': 1})
+        self.assertEqual(u2.counts(), {'posts': 0, 'followers': 2, 'following': 1})
+        self.assertEqual(u3.counts(), {'posts': 0, 'followers': 0, 'following': 1})
+
+        # the counts of a whole page of users are queried at once and must be the same as the single user counts
+        User.bulk_augment([u1, u2, u3])
+        self.assertEqual([u1._counts, u2._counts, u3._counts], [u1.counts(), u2.counts(), u3.counts()])
+
+    def test_feed_page(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        # posts 2, 3 and 4 have the same timestamp, the pages must still neither skip nor repeat any of them
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u, timestamp=now + timedelta(seconds=min(i, 2))) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        seen = []
+        cursor = None
+        while True:
+            items, cursor = Post.feed_page(u.posts.select(), cursor, per_page=2)
+            seen.extend(items)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [posts[4], posts[3], posts[2], posts[1], posts[0]])
+
+        # the same conditions in ascending order, as used by the export task
+        query = u.posts.select().order_by(Post.timestamp.asc(), Post.id.asc())
+        after = db.session.scalars(query.where(*Post.after(posts[2].timestamp, posts[2].id, descending=False))).all()
+        self.assertEqual(after, [posts[3], posts[4]])
+
+    def test_add_notification(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        # a second notification with the same name replaces the first one
+        u.add_notification('unread_message_count', 1)
+        u.add_notification('unread_message_count', 2)
+        u.add_notification('task_progress', {'progress': 50})
+        db.session.commit()
+        notifications = {n.name: n.get_data() for n in db.session.scalars(u.notifications.select())}
+        self.assertEqual(notifications, {'unread_message_count': 2, 'task_progress': {'progress': 50}})
+
+    def test_collection_without_count(self):
+        db.session.add_all([User(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)])
+        db.session.commit()
+
+        query = sa.select(User).order_by(User.id)
+        with self.app.test_request_context():
+            page1 = User.to_collection_dict(query, 1, 2, 'api.get_users', count=False)
+            page2 = User.to_collection_dict(query, 2, 2, 'api.get_users', count=False)
+        self.assertEqual(page1['_meta'], {'page': 1, 'per_page': 2})
+        self.assertEqual([u['username'] for u in page1['items']], ['user0', 'user1'])
+        self.assertEqual(page1['_links']['next'], '/api/users?page=2&per_page=2&count=false')
+        self.assertEqual([u['username'] for u in page2['items']], ['user2'])
+        self.assertIsNone(page2['_links']['next'])
+
+    def test_register_collation_match(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+        # a database collation matched 'jöhn ' to 'john' (e.g. MySQL), lower() doesn't, the error still has to be shown
+        with self.app.test_request_context(method='POST', data={'username': 'jöhn ', 'email': 'other@example.com',
+                                                                'password': 'cat', 'password2': 'cat'}):
+            form = RegistrationForm()
+            with mock.patch.object(db.session, 'execute') as execute:
+                execute.return_value.all.return_value = [('john', 'john@example.com')]
+                self.assertFalse(form.validate())
+        self.assertEqual(form.username.errors, ['That username already exists! Please use a different username.'])
+
+""" tests of the routes, through the test client of the app """
+class RouteCase(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = self.app.test_client()
+
+    """ logs the user in for the next requests of the test client, without going through the login form """
+    def _login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+
+    def test_streamed_pages_with_gzip(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        self._login(u)
+        # compression must not read the whole page before sending it
+        response = self.client.get('/explore', headers={'Accept-Encoding': 'gzip'}, buffered=False)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIsNone(response.content_length)
+        # the beginning of the page can already be decompressed before the rest is sent
+        decompressor = zlib.decompressobj(31)
+        chunks = iter(response.response)
+        head = decompressor.decompress(next(chunks) + next(chunks))
+        self.assertIn(b'<!doctype html>', head.lower())
+        self.assertNotIn(b'</html>', head)
+        response.close()
+
+        response = self.client.get('/explore', headers={'Accept-Encoding': 'gzip'})
+        self.assertIn(b'</html>', gzip.decompress(response.data))
+        response = self.client.get('/explore')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn(b'</html>', response.data)
+
+    def test_notifications_revalidation_with_gzip(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        # enough notifications for the response to be compressed
+        for i in range(12):
+            u.add_notification(f'task_progress_{i}', {'task_id': f'task-{i}', 'progress': 50})
+        db.session.commit()
+
+        self._login(u)
+        response = self.client.get('/notifications', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        etag = response.headers['ETag']
+        self.assertTrue(etag.endswith(':gzip"'))
+
+        # the browser sends back the ETag of the compressed response
+        response = self.client.get('/notifications', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # a new notification changes the ETag
+        u.add_notification('task_progress_12', {'task_id': 'task-12', 'progress': 50})
+        db.session.commit()
+        response = self.client.get('/notifications', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_htmx_follow_without_csrf_token(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        self._login(u1)
+        # htmx must load the page itself instead of following a redirect and swapping the page into the follow block
+        response = self.client.post('/follow/susan', headers={'HX-Request': 'true'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.headers['HX-Redirect'], '/index')
+        self.assertFalse(u1.is_following(u2))
+        # normal form submissions are still redirected
+        response = self.client.post('/follow/susan')
+        self.assertEqual(response.status_code, 302)
+
+    def test_register_race(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+        # john registers between the validation of the form and the commit, the commit then fails on the unique username
+        with mock.patch.object(RegistrationForm, 'validate_on_submit', lambda form: True):
+            response = self.client.post('/auth/register', data={'username': 'john', 'email': 'other@example.com',
+                                                                'password': 'cat', 'password2': 'cat'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'That username already exists!', response.data)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).select_from(User)), 1)
+
+    def test_edit_profile_race(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+
+        self._login(u1)
+        with mock.patch.object(EditProfileForm, 'validate_on_submit', lambda form: True):
+            response = self.client.post('/edit_profile', data={'username': 'susan', 'about_me': ''})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'That username already exists!', response.data)
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, u1.id).username, 'john')
+
+    def test_bfetch(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        u.add_notification('unread_message_count', 3)
+        db.session.commit()
+
+        self._login(u)
+        response = self.client.post('/bfetch', json={'requests': [
+            {'id': 1, 'endpoint': 'notifications', 'params': {'since': 0}},
+            {'id': 2, 'endpoint': 'unknown'},
+            {'id': 3, 'endpoint': ['notifications']},
+            {'id': 4, 'endpoint': {'name': 'notifications'}},
+            {'id': 5, 'endpoint': 'notifications', 'params': ['since']},
+            'not a request',
+        ]})
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[0]['id'], 1)
+        self.assertEqual([(n['name'], n['data']) for n in lines[0]['result']], [('unread_message_count', 3)])
+        self.assertEqual(lines[1:], [
+            {'id': 2, 'error': 'unknown endpoint'},
+            {'id': 3, 'error': 'unknown endpoint'},
+            {'id': 4, 'error': 'unknown endpoint'},
+            {'id': 5, 'error': 'invalid params'},
+            {'id': None, 'error': 'invalid request'},
+        ])
+
+    def test_bfetch_invalid_body(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        self._login(u)
+        self.assertEqual(self.client.post('/bfetch', json=['notifications']).status_code, 400)
+        self.assertEqual(self.client.post('/bfetch', json={'requests': {'id': 1}}).status_code, 400)
+        too_many = [{'id': i, 'endpoint': 'notifications'} for i in range(self.app.config['BFETCH_MAX_REQUESTS'] + 1)]
+        self.assertEqual(self.client.post('/bfetch', json={'requests': too_many}).status_code, 400)
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file